@@ -8,6 +8,7 @@ import click
 from pafaders.controller import Controller
 from pafaders.midi import MidiListener
 from pafaders.applications import Applications
+from pafaders import snapshot
 
 
 LOG = logging.getLogger(__name__)
@@ -15,7 +16,25 @@ LOG = logging.getLogger(__name__)
 
 @click.command()
 @click.option("--verbose", "-v", count=True)
-def main(verbose):
+@click.option(
+    "--snapshot",
+    "snapshot_path",
+    type=click.Path(dir_okay=False),
+    default=snapshot.default_path,
+    show_default="$XDG_STATE_HOME/pafaders/snapshot.json",
+    help="File for remembering application slots and volumes between runs.",
+)
+@click.option("--no-snapshot", is_flag=True, help="Do not restore or save slots.")
+@click.option(
+    "--bank-buttons",
+    nargs=2,
+    type=int,
+    default=None,
+    metavar="PREVIOUS NEXT",
+    help="CC numbers on MIDI channel 16 of the buttons that page through "
+    "applications beyond the first eight.",
+)
+def main(verbose, snapshot_path, no_snapshot, bank_buttons):
     if verbose > 0:
         level = logging.DEBUG - verbose + 1
     else:
@@ -25,8 +44,13 @@ def main(verbose):
 
     controller = Controller()
 
-    with Applications(controller=controller) as apps:
-        with MidiListener(controller=controller) as listener:
+    if no_snapshot:
+        snapshot_path = None
+
+    with Applications(controller=controller, snapshot_path=snapshot_path) as apps:
+        with MidiListener(
+            controller=controller, bank_buttons=bank_buttons or None
+        ) as listener:
             try:
                 while True:
                     # Periodically check for new MIDI ports
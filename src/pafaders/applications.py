@@ -1,16 +1,40 @@
 """MPRIS 2 media player and PulseAudio sink input interface."""
 
+import concurrent.futures
 import enum
 import logging
 import threading
+import time
 
 import dbus
 import mpris2
 import pulsectl
 
+from pafaders import snapshot
+
 
 LOG = logging.getLogger(__name__)
 
+# Upper bound in seconds for how long a button press waits for MPRIS
+# commands, and D-Bus reply timeout for each command.
+MPRIS_COMMAND_TIMEOUT = 0.5
+MPRIS_COMMAND_WORKERS = 8
+
+# Number of application slots, matching the faders of one bank. Once
+# they are taken, new applications replace inactive ones.
+APP_SLOTS = 8
+
+MPRIS_OBJECT_PATH = "/org/mpris/MediaPlayer2"
+MPRIS_PLAYER_INTERFACE = "org.mpris.MediaPlayer2.Player"
+
+# Volume readings closer than this to the last known volume are not
+# reported as changes. Half a fader step.
+VOLUME_TOLERANCE = 0.5 / 127
+
+# Readings taken this soon after we set the volume ourselves may not
+# reflect the write yet, and are ignored to avoid fighting the faders.
+ECHO_SUPPRESSION_TIME = 1.0
+
 
 class PlaybackStatus(enum.Enum):
     PLAYING = "Playing"
@@ -29,9 +53,17 @@ class Application:
         self.pa_sink_inputs = []
         self.mpris_app = None
         self.mpris_player = None
+        self.mpris_player_object = None
         self.cached_mpris_identity = None
+        self.cached_playback_status = None
         self.active_sink_inputs = {}
         self.volume = None
+        self.volume_generation = 0
+        self.volume_set_at = None
+        # Set when the volume should be applied once the application
+        # becomes active, such as for slots restored from a snapshot.
+        self.volume_pending = False
+        self.restored_name = None
 
         if pa_sink_input is not None:
             self.add_sink_input(pa_sink_input)
@@ -52,6 +84,35 @@ class Application:
 
         return app_class(pa_sink_input=pa_sink_input, mpris_player_uri=mpris_player_uri)
 
+    @classmethod
+    def from_snapshot(cls, slot):
+        """Create an inactive placeholder application for a saved slot."""
+        for subclass in cls.__subclasses__():
+            if subclass.__name__ == slot.get("class"):
+                app_class = subclass
+                break
+        else:
+            app_class = cls
+
+        app = app_class()
+        app.restored_name = slot.get("name")
+        app.volume = slot.get("volume")
+        app.volume_pending = app.volume is not None
+        return app
+
+    def snapshot(self):
+        # Use the cached MPRIS identity when there is one, to avoid a
+        # D-Bus round trip on every check.
+        if self.name_override is None and self.cached_mpris_identity is not None:
+            name = self.cached_mpris_identity
+        else:
+            name = self.name()
+        return {
+            "class": self.__class__.__name__,
+            "name": name,
+            "volume": self.volume,
+        }
+
     @classmethod
     def handles_pa_sink_input(cls, pa_sink_input):
         return False
@@ -85,6 +146,9 @@ class Application:
         if self.mpris_app is not None:
             return self.mpris_identity()
 
+        if not self.pa_sink_inputs and self.restored_name is not None:
+            return self.restored_name
+
         app_names = {si.proplist["application.name"] for si in self.pa_sink_inputs}
         media_names = {si.proplist["media.name"] for si in self.pa_sink_inputs}
 
@@ -122,6 +186,16 @@ class Application:
             dbus_interface_info={"dbus_uri": player_uri}
         )
         self.mpris_player = mpris2.Player(dbus_interface_info={"dbus_uri": player_uri})
+        # Plain proxy for commands, which lets us pass a reply timeout.
+        self.mpris_player_object = dbus.SessionBus().get_object(
+            player_uri, MPRIS_OBJECT_PATH, introspect=False
+        )
+
+    def update_sink_input(self, pa_sink_input):
+        # Replace the snapshot from an earlier poll so that we see the
+        # current volume.
+        if pa_sink_input.index in self.active_sink_inputs:
+            self.active_sink_inputs[pa_sink_input.index] = pa_sink_input
 
     def remove_sink_input_index(self, index):
         try:
@@ -132,6 +206,8 @@ class Application:
     def remove_player(self):
         self.mpris_app = None
         self.mpris_player = None
+        self.mpris_player_object = None
+        self.cached_playback_status = None
 
     def set_pa_volume(self, *, volume, pulse):
         for si in self.active_sink_inputs.values():
@@ -147,6 +223,34 @@ class Application:
         else:
             self.set_pa_volume(volume=volume, pulse=pulse)
 
+    def get_pa_volume(self):
+        volumes = [si.volume.value_flat for si in self.active_sink_inputs.values()]
+        if volumes:
+            return max(volumes)
+        return None
+
+    def get_mpris_volume(self):
+        try:
+            return float(self.mpris_player.Volume)
+        except dbus.exceptions.DBusException:
+            return None
+
+    def get_volume(self):
+        if self.mpris_player is not None:
+            return self.get_mpris_volume()
+        else:
+            return self.get_pa_volume()
+
+    def note_volume_set(self):
+        self.volume_generation += 1
+        self.volume_set_at = time.monotonic()
+
+    def volume_recently_set(self):
+        return (
+            self.volume_set_at is not None
+            and time.monotonic() - self.volume_set_at < ECHO_SUPPRESSION_TIME
+        )
+
     def fix_volume(self, *, pulse):
         if self.SHOULD_FIX_VOLUME and self.volume is not None:
             self.set_volume(volume=self.volume, pulse=pulse)
@@ -157,21 +261,38 @@ class Application:
             return None
         else:
             try:
-                return PlaybackStatus(self.mpris_player.PlaybackStatus)
+                status = PlaybackStatus(self.mpris_player.PlaybackStatus)
             except dbus.exceptions.DBusException:
                 return None
+            self.cached_playback_status = status
+            return status
+
+    def may_need_pause(self):
+        # Use the status from the last poll, so that we don't need a
+        # round trip to every player before pausing them.
+        return self.mpris_player is not None and self.cached_playback_status not in (
+            PlaybackStatus.PAUSED,
+            PlaybackStatus.STOPPED,
+        )
 
     def play_or_pause(self):
         if self.mpris_player is not None:
-            self.mpris_player.PlayPause()
+            self.call_mpris_player("PlayPause")
 
     def play(self):
         if self.mpris_player is not None:
-            self.mpris_player.Play()
+            self.call_mpris_player("Play")
+            self.cached_playback_status = PlaybackStatus.PLAYING
 
     def pause(self):
         if self.mpris_player is not None:
-            self.mpris_player.Pause()
+            self.call_mpris_player("Pause")
+            self.cached_playback_status = PlaybackStatus.PAUSED
+
+    def call_mpris_player(self, method):
+        getattr(self.mpris_player_object, method)(
+            dbus_interface=MPRIS_PLAYER_INTERFACE, timeout=MPRIS_COMMAND_TIMEOUT
+        )
 
     def __repr__(self):
         indices = ", ".join(f"#{index}" for index in self.active_sink_inputs)
@@ -199,8 +320,12 @@ class Firefox(Application):
     def set_volume(self, *, volume, pulse):
         # The media player object of Firefox does not support volume
         # changes.
+        self.volume = volume
         self.set_pa_volume(volume=volume, pulse=pulse)
 
+    def get_volume(self):
+        return self.get_pa_volume()
+
 
 class Rhythmbox(Application):
     @classmethod
@@ -224,8 +349,12 @@ class Spotify(Application):
     def set_volume(self, *, volume, pulse):
         # The media player object of Spotify does not respond to
         # volume changes.
+        self.volume = volume
         self.set_pa_volume(volume=volume, pulse=pulse)
 
+    def get_volume(self):
+        return self.get_pa_volume()
+
 
 class Discord(Application):
     name_override = "Discord"
@@ -236,8 +365,10 @@ class Discord(Application):
 
 
 class Applications:
-    def __init__(self, *, controller):
+    def __init__(self, *, controller, snapshot_path=None):
         self.controller = controller
+        self.snapshot_path = snapshot_path
+        self.saved_snapshot = None
         self.controller.subscribe("set_volume", self.set_volume)
         self.controller.subscribe("play_or_pause", self.play_or_pause)
         self.pulse = pulsectl.Pulse("pafaders")
@@ -246,28 +377,81 @@ class Applications:
         self.app_list = []
         self.playback_status_list = []
         self.playing_app = None
+        self.mpris_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=MPRIS_COMMAND_WORKERS, thread_name_prefix="mpris"
+        )
+        # Outstanding MPRIS command for each application
+        self.mpris_futures = {}
+        self.mpris_lock = threading.Lock()
 
         # We may be called via callback functions in other threads.
         self.lock = threading.Lock()
 
     def __enter__(self):
         self.pulse.__enter__()
+        self.load_snapshot()
         return self
 
     def __exit__(self, *args):
+        self.save_snapshot()
+        with self.mpris_lock:
+            for future in self.mpris_futures.values():
+                future.cancel()
+        self.mpris_executor.shutdown(wait=False)
         return self.pulse.__exit__(*args)
 
+    def load_snapshot(self):
+        if self.snapshot_path is None:
+            return
+
+        slots = snapshot.load(self.snapshot_path)
+        with self.lock:
+            self.app_list = [Application.from_snapshot(slot) for slot in slots]
+            self.saved_snapshot = slots
+        LOG.debug("Restored apps %r", self.app_list)
+        self.controller.set_application_list(self.app_list)
+
+    def save_snapshot(self):
+        if self.snapshot_path is None:
+            return
+
+        with self.lock:
+            apps = list(self.app_list)
+        # Don't remember inactive apps beyond the first slots
+        while len(apps) > APP_SLOTS and not apps[-1].active():
+            apps.pop()
+        slots = [app.snapshot() for app in apps]
+        if slots != self.saved_snapshot:
+            if snapshot.save(self.snapshot_path, slots):
+                self.saved_snapshot = slots
+
+    def apply_pending_volumes(self):
+        # Restore the volumes of all newly active apps in one pass.
+        with self.lock:
+            for app in self.app_list:
+                if app.volume_pending and app.active():
+                    LOG.debug("Restoring volume %r of %r", app.volume, app)
+                    app.volume_pending = False
+                    app.note_volume_set()
+                    try:
+                        app.set_volume(volume=app.volume, pulse=self.pulse)
+                    except (dbus.exceptions.DBusException, pulsectl.PulseError):
+                        LOG.exception("Could not restore volume of %r", app)
+
     def add_app(self, new_app):
         # Replace similar app
         for n, app in enumerate(self.app_list):
             if not app.active() and new_app.may_replace_app(app):
+                if new_app.volume is None and app.volume is not None:
+                    new_app.volume = app.volume
+                    new_app.volume_pending = True
                 self.app_list[n] = new_app
                 return False
 
         # Take position of removed app if we are full
-        if len(self.app_list) > 8:
+        if len(self.app_list) >= APP_SLOTS:
             for n, app in enumerate(self.app_list):
-                if not app.active:
+                if not app.active():
                     self.app_list[n] = new_app
                     return True
 
@@ -329,6 +513,8 @@ class Applications:
                 if si.index not in self.app_by_sink_input_index:
                     self.add_sink_input(si)
                     changed = True
+                else:
+                    self.app_by_sink_input_index[si.index].update_sink_input(si)
 
             return changed
 
@@ -380,6 +566,34 @@ class Applications:
 
         return changed
 
+    def update_volumes(self):
+        """Return (slot, volume) for volumes changed outside of pafaders."""
+        with self.lock:
+            apps = [
+                (n, app, app.volume_generation)
+                for n, app in enumerate(self.app_list)
+                if app.active() and not app.volume_recently_set()
+            ]
+
+        changes = []
+        for n, app, generation in apps:
+            # Read without holding the lock, since D-Bus calls may be
+            # slow.
+            volume = app.get_volume()
+            if volume is None:
+                continue
+            with self.lock:
+                if app.volume_generation != generation:
+                    # We set the volume while reading it
+                    continue
+                previous = app.volume
+                if previous is not None and abs(volume - previous) < VOLUME_TOLERANCE:
+                    continue
+                LOG.debug("Volume of %r changed to %r", app, volume)
+                app.volume = volume
+                changes.append((n, volume))
+        return changes
+
     def check(self):
         # Poll for updates. We might listen for events instead, but
         # then we cannot use blocking APIs like sink_input_list() at
@@ -391,6 +605,15 @@ class Applications:
         if changed0 or changed1:
             self.controller.set_application_list(self.app_list)
 
+        self.apply_pending_volumes()
+
+        # Polling once per check coalesces rapid external changes,
+        # such as dragging a slider in pavucontrol.
+        for n, volume in self.update_volumes():
+            self.controller.volume_changed(app=n, volume=volume)
+
+        self.save_snapshot()
+
     def set_volume(self, *, app, volume):
         with self.lock:
             try:
@@ -398,20 +621,71 @@ class Applications:
             except IndexError:
                 return
 
-            if app_instance.active:
-                app_instance.set_volume(volume=volume, pulse=self.pulse)
+            if not app_instance.active():
+                # Applied when the application shows up again
+                app_instance.volume = volume
+                app_instance.volume_pending = True
+                return
+
+            app_instance.note_volume_set()
+            app_instance.set_volume(volume=volume, pulse=self.pulse)
+
+    def run_mpris_commands(self, commands):
+        """Issue MPRIS commands concurrently and wait for them a bounded time.
+
+        commands is a list of (application, function) pairs. Commands
+        for applications that still have one outstanding are skipped.
+
+        """
+        futures = {}
+        with self.mpris_lock:
+            self.mpris_futures = {
+                app: future
+                for app, future in self.mpris_futures.items()
+                if not future.done()
+            }
+            for app, fn in commands:
+                if app in self.mpris_futures:
+                    LOG.warning("Skipping MPRIS command %r, %r is busy", fn, app)
+                    continue
+                future = self.mpris_executor.submit(fn)
+                self.mpris_futures[app] = future
+                futures[future] = fn
+
+        done, not_done = concurrent.futures.wait(futures, timeout=MPRIS_COMMAND_TIMEOUT)
+        for future in done:
+            if future.cancelled():
+                continue
+            exception = future.exception()
+            if exception is not None:
+                LOG.warning("MPRIS command %r failed: %s", futures[future], exception)
+        for future in not_done:
+            # Don't let a late command run after the user has moved on
+            if future.cancel():
+                LOG.warning("MPRIS command %r cancelled", futures[future])
+            else:
+                LOG.warning("MPRIS command %r timed out", futures[future])
 
     def play_or_pause(self, *, app=None):
         if app is None:
-            self.playing_app.play_or_pause()
+            if self.playing_app is not None:
+                self.run_mpris_commands(
+                    [(self.playing_app, self.playing_app.play_or_pause)]
+                )
             return
 
-        playing = self.app_list[app].playback_status == PlaybackStatus.PLAYING
-        if playing:
-            self.app_list[app].pause()
+        try:
+            selected_app = self.app_list[app]
+        except IndexError:
+            return
+
+        # Use the polled status, so that a press costs no extra round
+        # trip and cannot block on an unresponsive player.
+        if selected_app.cached_playback_status == PlaybackStatus.PLAYING:
+            self.run_mpris_commands([(selected_app, selected_app.pause)])
         else:
-            for index, app_object in enumerate(self.app_list):
-                if index == app:
-                    app_object.play()
-                else:
-                    app_object.pause()
+            commands = [(selected_app, selected_app.play)]
+            for app_object in self.app_list:
+                if app_object is not selected_app and app_object.may_need_pause():
+                    commands.append((app_object, app_object.pause))
+            self.run_mpris_commands(commands)
@@ -1,14 +1,41 @@
+import threading
 from collections import defaultdict
 
+from pafaders.render import Renderer
+
 
 class Controller:
     def __init__(self):
         self.subscribers = defaultdict(set)
+        self.surfaces = set()
+        self.renderer = Renderer()
+        # Surfaces may register or change bank from MIDI callback
+        # threads.
+        self.render_lock = threading.Lock()
 
     def subscribe(self, message, fn):
         self.subscribers[message].add(fn)
 
+    def register_surface(self, surface):
+        with self.render_lock:
+            self.surfaces.add(surface)
+            self.renderer.render(surface)
+
+    def unregister_surface(self, surface):
+        with self.render_lock:
+            self.surfaces.discard(surface)
+
+    def refresh_surface(self, surface):
+        with self.render_lock:
+            self.renderer.render(surface)
+
     def set_application_list(self, apps):
+        with self.render_lock:
+            changed_slots = self.renderer.set_application_list(apps)
+            if changed_slots:
+                for surface in self.surfaces:
+                    self.renderer.render(surface, changed_slots)
+
         for fn in self.subscribers["set_application_list"]:
             fn(apps)
 
@@ -16,6 +43,10 @@ class Controller:
         for fn in self.subscribers["set_volume"]:
             fn(app=app, volume=volume)
 
+    def volume_changed(self, *, app, volume):
+        for fn in self.subscribers["volume_changed"]:
+            fn(app=app, volume=volume)
+
     def play_or_pause(self, *, app=None):
         for fn in self.subscribers["play_or_pause"]:
             fn(app=app)
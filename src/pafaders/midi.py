@@ -1,12 +1,18 @@
 """MIDI input/feedback implementation."""
 
+import collections
+import enum
+import itertools
 import logging
+import threading
 import time
 from datetime import datetime
 
 import rtmidi
 from rtmidi.midiconstants import CONTROL_CHANGE, SYSTEM_EXCLUSIVE, END_OF_EXCLUSIVE
 
+from pafaders.render import Surface
+
 
 CHAN_16_CC = CONTROL_CHANGE | 0xF
 
@@ -15,14 +21,161 @@ DUMP_SYSEX_MESSAGES_TO_FILE = False
 
 LOG = logging.getLogger(__name__)
 
+# Raw MIDI 1.0 bandwidth: 31250 baud with 10 bits per byte.
+DEFAULT_MAX_OUTPUT_BYTES_PER_SECOND = 3125
+
+# Time in seconds to wait for queued output when shutting down.
+OUTPUT_DRAIN_TIMEOUT = 2.0
+
+
+class Priority(enum.IntEnum):
+    """Output priority classes. Lower values are sent first."""
+
+    CONTROL = 0
+    DISPLAY = 1
+
+
+class MidiOutputScheduler:
+    """Rate limited, prioritized writer for a single MIDI output port.
+
+    All messages are sent from one writer thread. Messages queued with
+    the same key replace each other if the earlier one has not been
+    sent yet, which lets display writes to the same line coalesce.
+
+    """
+
+    def __init__(
+        self,
+        *,
+        out_port,
+        port_name,
+        max_bytes_per_second=DEFAULT_MAX_OUTPUT_BYTES_PER_SECOND,
+    ):
+        self.out_port = out_port
+        self.port_name = port_name
+        self.max_bytes_per_second = max_bytes_per_second
+        self.log = LOG.getChild(self.__class__.__name__)
+
+        self.queues = {priority: collections.OrderedDict() for priority in Priority}
+        self.sequence = itertools.count()
+        self.next_send_time = 0.0
+        self.stopping = False
+
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.coalesced_messages = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(
+            target=self.run, name=f"midi-out {port_name}", daemon=True
+        )
+        self.thread.start()
+
+    def send(self, message, *, priority=Priority.CONTROL, key=None):
+        with self.condition:
+            if self.stopping:
+                self.log.warning(
+                    "Port %r, Dropping message after close", self.port_name
+                )
+                return
+            queue = self.queues[priority]
+            if key is None:
+                key = ("unkeyed", next(self.sequence))
+            if key in queue:
+                # Keep the time of the superseded message, so that the
+                # latency metric shows how long the slot waited.
+                _, queued_at = queue.pop(key)
+                self.coalesced_messages += 1
+            else:
+                queued_at = time.monotonic()
+            queue[key] = (message, queued_at)
+            self.condition.notify()
+
+    def pending(self):
+        return any(self.queues.values())
+
+    def next_message(self):
+        for priority in Priority:
+            queue = self.queues[priority]
+            if queue:
+                _, item = queue.popitem(last=False)
+                return item
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending() and not self.stopping:
+                    self.condition.wait()
+                if not self.pending():
+                    return
+                delay = self.next_send_time - time.monotonic()
+                if delay > 0:
+                    # Wait outside of the queues so that more important
+                    # messages and coalesced writes can still arrive.
+                    self.condition.wait(delay)
+                    continue
+                message, queued_at = self.next_message()
+
+            try:
+                self.out_port.send_message(message)
+            except (rtmidi.InvalidUseError, rtmidi.SystemError):
+                self.log.exception("Port %r, send_message", self.port_name)
+                continue
+
+            now = time.monotonic()
+            self.next_send_time = now + len(message) / self.max_bytes_per_second
+
+            with self.condition:
+                latency = now - queued_at
+                self.sent_messages += 1
+                self.sent_bytes += len(message)
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self.total_latency += latency
+
+    def metrics(self):
+        with self.condition:
+            return {
+                "queue_depth": {
+                    priority.name: len(queue) for priority, queue in self.queues.items()
+                },
+                "sent_messages": self.sent_messages,
+                "sent_bytes": self.sent_bytes,
+                "coalesced_messages": self.coalesced_messages,
+                "last_latency": self.last_latency,
+                "max_latency": self.max_latency,
+                "mean_latency": (
+                    self.total_latency / self.sent_messages
+                    if self.sent_messages
+                    else None
+                ),
+            }
+
+    def close(self, *, timeout=OUTPUT_DRAIN_TIMEOUT):
+        """Send the queued messages and stop the writer thread."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            self.log.warning("Port %r, Output not drained on close", self.port_name)
+        self.log.debug("Port %r, Output metrics %r", self.port_name, self.metrics())
+
 
 class MidiPortListener:
     """Generic logging MIDI listener for a single port."""
 
-    def __init__(self, *, port, port_name, controller):
+    def __init__(self, *, port, port_name, controller, bank_buttons=None):
         self.port = port
         self.port_name = port_name
         self.controller = controller
+        # CC numbers of the buttons selecting the previous and next
+        # bank, or None.
+        self.bank_buttons = bank_buttons
         self.log = LOG.getChild(self.__class__.__name__)
 
         self.port.set_callback(self.callback)
@@ -67,7 +220,7 @@ class MidiPortListener:
         self.port.close_port()
 
 
-class RemoteZeroSLListener(MidiPortListener):
+class RemoteZeroSLListener(MidiPortListener, Surface):
     """Novation ReMOTE ZeRO SL listener implementation.
 
     Display updating info from
@@ -107,10 +260,24 @@ class RemoteZeroSLListener(MidiPortListener):
     FADER_BUTTONS_2 = list(range(48, 56))
     PLAY = 75
 
-    def __init__(self, *, port, port_name, controller):
-        super().__init__(port=port, port_name=port_name, controller=controller)
+    MAX_OUTPUT_BYTES_PER_SECOND = DEFAULT_MAX_OUTPUT_BYTES_PER_SECOND
+
+    SLOT_COUNT = len(FADERS)
+    CELL_WIDTH = 8
+    # Application names and states on the two lines of the right
+    # display, with a space between cells.
+    NAME_BUFFER = 2
+    STATE_BUFFER = 3
+
+    def __init__(self, *, port, port_name, controller, bank_buttons=None):
+        super().__init__(
+            port=port,
+            port_name=port_name,
+            controller=controller,
+            bank_buttons=bank_buttons,
+        )
 
-        self.controller.subscribe("set_application_list", self.set_application_list)
+        self.controller.subscribe("volume_changed", self.volume_changed)
 
         midi_out = rtmidi.MidiOut()
         ports = midi_out.get_ports()
@@ -121,10 +288,16 @@ class RemoteZeroSLListener(MidiPortListener):
                 break
         else:
             raise SystemError("No matching output port found")
+        self.output = MidiOutputScheduler(
+            out_port=self.out_port,
+            port_name=self.port_name,
+            max_bytes_per_second=self.MAX_OUTPUT_BYTES_PER_SECOND,
+        )
         self.log.info("Found ReMOTE ZeRO SL")
-        self.out_port.send_message(self.AUTOMAP_ENGAGE_SYSEX)
+        self.output.send(self.AUTOMAP_ENGAGE_SYSEX, priority=Priority.CONTROL)
         self.clear_display_buffers()
         self.update_displays()
+        self.controller.register_surface(self)
 
     @classmethod
     def handles(cls, *, port_name):
@@ -137,14 +310,20 @@ class RemoteZeroSLListener(MidiPortListener):
             control, value = octets[1:]
             # CC 16..23 correspond to the faders
             if control in self.FADERS:
-                app = control - self.FADERS[0]
+                app = self.slot(control - self.FADERS[0])
                 volume = value / 127.0
                 self.set_volume(app=app, volume=volume)
             if control in self.FADER_BUTTONS_2 and value == 1:
-                app = control - self.FADER_BUTTONS_2[0]
+                app = self.slot(control - self.FADER_BUTTONS_2[0])
                 self.play_or_pause(app=app)
             elif control == self.PLAY and value == 1:
                 self.play_or_pause()
+            elif self.bank_buttons and control in self.bank_buttons and value == 1:
+                previous_bank_button, _ = self.bank_buttons
+                if control == previous_bank_button:
+                    self.set_bank(self.bank - 1)
+                else:
+                    self.set_bank(self.bank + 1)
         elif octets == self.AUTOMAP_ENGAGE_SYSEX:
             # We need to wait for the transient template change
             # message to disappear from the display.
@@ -162,7 +341,7 @@ class RemoteZeroSLListener(MidiPortListener):
                 + self.TEXT_SYSEX_PREFIX
                 + [0x00, 0x02, 0x02, display, END_OF_EXCLUSIVE]
             )
-            self.out_port.send_message(msg)
+            self.output.send(msg, priority=Priority.DISPLAY)
 
     def show_text(self, *, display, line, column, text):
         line_id = line * 2 + display + 1
@@ -174,45 +353,83 @@ class RemoteZeroSLListener(MidiPortListener):
             + text
             + [END_OF_EXCLUSIVE]
         )
-        self.out_port.send_message(msg)
+        # A pending write to the same part of the line is superseded
+        # by this one.
+        self.output.send(
+            msg, priority=Priority.DISPLAY, key=(line_id, column, len(text))
+        )
 
     def update_displays(self):
         for n, line in enumerate(self.display_buffers):
             self.show_text(display=(n >> 1), line=(n & 1), column=0, text=line)
 
-    def set_application_list(self, apps):
-        self.clear_display_buffers()
+    def show_buffer_text(self, *, buffer, column, text):
+        end = column + len(text)
+        self.display_buffers[buffer][column:end] = text
+        self.show_text(
+            display=(buffer >> 1),
+            line=(buffer & 1),
+            column=column,
+            text=list(text),
+        )
 
-        names = []
-        states = []
-        for app in apps:
-            if not app.active():
-                names.append("--------")
-            else:
-                names.append(f"{app.name()[0:8]:<8}")
+    def update_cells(self, changes):
+        for position, cells in changes.items():
+            column = position * (self.CELL_WIDTH + 1)
+            self.show_buffer_text(
+                buffer=self.NAME_BUFFER, column=column, text=cells.name
+            )
+            self.show_buffer_text(
+                buffer=self.STATE_BUFFER, column=column, text=cells.state
+            )
 
-            status = app.playback_status
-            if status is None:
-                states.append("        ")
-            else:
-                states.append(f"{status.value:^8}")
+            # The slot may have moved, so send its level again.
+            volume = self.controller.renderer.volume(self.slot(position))
+            if volume is not None:
+                self.send_volume(position=position, volume=volume)
+
+    def set_bank(self, bank):
+        """Show the slots from bank * SLOT_COUNT onwards."""
+        slot_count = self.controller.renderer.slot_count()
+        last_bank = max(0, (slot_count - 1) // self.SLOT_COUNT)
+        bank = max(0, min(bank, last_bank))
+        if bank != self.bank:
+            self.log.debug("Port %r, Bank %d", self.port_name, bank)
+            self.bank = bank
+            self.controller.refresh_surface(self)
+
+    def volume_changed(self, *, app, volume):
+        position = self.position(app)
+        if position is not None:
+            self.send_volume(position=position, volume=volume)
+
+    def send_volume(self, *, position, volume):
+        control = self.FADERS[position]
+        value = max(0, min(127, round(volume * 127)))
+        # Only the latest unsent level for each fader is kept.
+        self.output.send(
+            [CHAN_16_CC, control, value],
+            priority=Priority.CONTROL,
+            key=("fader", control),
+        )
 
-        app_names = " ".join(names).encode("ascii")
-        app_states = " ".join(states).encode("ascii")
-        self.display_buffers[2][: len(app_names)] = app_names
-        self.display_buffers[3][: len(app_states)] = app_states
-        self.update_displays()
+    def output_metrics(self):
+        return self.output.metrics()
 
     def shutdown(self):
+        self.controller.unregister_surface(self)
         self.clear_displays()
+        self.output.close()
+        self.out_port.close_port()
         super().shutdown()
 
 
 class MidiListener:
     """Overarching MIDI listener object."""
 
-    def __init__(self, *, controller):
+    def __init__(self, *, controller, bank_buttons=None):
         self.controller = controller
+        self.bank_buttons = bank_buttons
         self.port_listeners = {}
         self.midi_in = None
 
@@ -224,6 +441,13 @@ class MidiListener:
             listener.shutdown()
         return False
 
+    def output_metrics(self):
+        return {
+            name: listener.output_metrics()
+            for name, listener in self.port_listeners.items()
+            if hasattr(listener, "output_metrics")
+        }
+
     def check_ports(self):
         while True:
             midi_in = self.midi_in or rtmidi.MidiIn()
@@ -242,7 +466,10 @@ class MidiListener:
                             )
                             port = midi_in.open_port(index)
                             listener = listener_class(
-                                port=port, port_name=name, controller=self.controller
+                                port=port,
+                                port_name=name,
+                                controller=self.controller,
+                                bank_buttons=self.bank_buttons,
                             )
                             self.port_listeners[name] = listener
                             self.midi_in = None
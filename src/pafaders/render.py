@@ -0,0 +1,131 @@
+"""Shared rendering of application slots for control surfaces."""
+
+import collections
+
+
+Cells = collections.namedtuple("Cells", ["name", "state"])
+
+
+class Renderer:
+    """Display cells for every application slot.
+
+    Cells are computed at most once per version of the application
+    list and cell width, and shared by all attached surfaces.
+
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.apps = []
+        self.slot_keys = []
+        self.cells_by_width = {}
+
+    @staticmethod
+    def slot_key(app):
+        status = app.playback_status
+        return (app.active(), app.name(), None if status is None else status.value)
+
+    def set_application_list(self, apps):
+        """Update the slots and return the indices of changed slots."""
+        slot_keys = [self.slot_key(app) for app in apps]
+        self.apps = list(apps)
+
+        changed = {
+            n
+            for n in range(max(len(slot_keys), len(self.slot_keys)))
+            if n >= len(slot_keys)
+            or n >= len(self.slot_keys)
+            or slot_keys[n] != self.slot_keys[n]
+        }
+        if changed:
+            self.slot_keys = slot_keys
+            self.version += 1
+            self.cells_by_width = {}
+        return changed
+
+    @staticmethod
+    def render_cells(slot_key, width):
+        active, name, status = slot_key
+        if not active:
+            name_cell = "-" * width
+        else:
+            name_cell = f"{name[0:width]:<{width}}"
+
+        if status is None:
+            state_cell = " " * width
+        else:
+            state_cell = f"{status[0:width]:^{width}}"
+
+        return Cells(
+            name=name_cell.encode("ascii", "replace"),
+            state=state_cell.encode("ascii", "replace"),
+        )
+
+    def cells(self, width):
+        try:
+            return self.cells_by_width[width]
+        except KeyError:
+            cells = [self.render_cells(key, width) for key in self.slot_keys]
+            self.cells_by_width[width] = cells
+            return cells
+
+    def blank_cells(self, width):
+        return Cells(name=b" " * width, state=b" " * width)
+
+    def slot_count(self):
+        return len(self.slot_keys)
+
+    def volume(self, slot):
+        try:
+            app = self.apps[slot]
+        except IndexError:
+            return None
+        if not app.active():
+            return None
+        return app.volume
+
+    def render(self, surface, changed_slots=None):
+        """Send the cells of the visible slots to a surface.
+
+        Only slots in changed_slots are sent, unless it is None.
+
+        """
+        cells = self.cells(surface.CELL_WIDTH)
+        changes = {}
+        for position, slot in enumerate(surface.visible_slots()):
+            if changed_slots is not None and slot not in changed_slots:
+                continue
+            if slot < len(cells):
+                changes[position] = cells[slot]
+            else:
+                changes[position] = self.blank_cells(surface.CELL_WIDTH)
+        if changes:
+            surface.update_cells(changes)
+
+
+class Surface:
+    """Base class for displays that show a bank of application slots.
+
+    Subclasses implement update_cells(changes), which receives a dict
+    of slot position on the surface to Cells.
+
+    """
+
+    SLOT_COUNT = 8
+    CELL_WIDTH = 8
+
+    bank = 0
+
+    def visible_slots(self):
+        first = self.bank * self.SLOT_COUNT
+        return range(first, first + self.SLOT_COUNT)
+
+    def slot(self, position):
+        return self.bank * self.SLOT_COUNT + position
+
+    def position(self, slot):
+        """Return the position of slot on this surface, or None."""
+        position = slot - self.bank * self.SLOT_COUNT
+        if 0 <= position < self.SLOT_COUNT:
+            return position
+        return None
@@ -0,0 +1,93 @@
+"""On-disk snapshot of application slots and volumes."""
+
+import json
+import logging
+import math
+import os
+import tempfile
+
+
+LOG = logging.getLogger(__name__)
+
+VERSION = 1
+
+# Highest volume accepted from a snapshot, same as pavucontrol.
+MAX_VOLUME = 1.5
+
+
+def default_path():
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".local", "state"
+    )
+    return os.path.join(state_home, "pafaders", "snapshot.json")
+
+
+def load(path):
+    """Return the list of saved slots, or an empty list."""
+    try:
+        with open(path, encoding="utf-8") as snapshot_file:
+            data = json.load(snapshot_file)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError):
+        LOG.exception("Could not read snapshot %s", path)
+        return []
+
+    if not isinstance(data, dict) or data.get("version") != VERSION:
+        LOG.warning("Ignoring snapshot %s with unknown version", path)
+        return []
+
+    slots = data.get("slots", [])
+    if not isinstance(slots, list) or not all(valid_slot(slot) for slot in slots):
+        LOG.warning("Ignoring snapshot %s with invalid slots", path)
+        return []
+    return slots
+
+
+def valid_slot(slot):
+    if not isinstance(slot, dict):
+        return False
+    if not isinstance(slot.get("class"), (str, type(None))):
+        return False
+    if not isinstance(slot.get("name"), (str, type(None))):
+        return False
+    volume = slot.get("volume")
+    if volume is None:
+        return True
+    if not isinstance(volume, (int, float)) or isinstance(volume, bool):
+        return False
+    return math.isfinite(volume) and 0 <= volume <= MAX_VOLUME
+
+
+def save(path, slots):
+    """Write the slots to path, replacing the previous snapshot atomically.
+
+    Return True if the snapshot was written.
+
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    except OSError:
+        LOG.exception("Could not write snapshot %s", path)
+        return False
+
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as snapshot_file:
+            json.dump(
+                {"version": VERSION, "slots": slots},
+                snapshot_file,
+                separators=(",", ":"),
+            )
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, path)
+    except OSError:
+        LOG.exception("Could not write snapshot %s", path)
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        return False
+    return True